@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from base_bert import BertPreTrainedModel
 from utils import *
 
@@ -181,8 +182,17 @@ class BertModel(BertPreTrainedModel):
     self.pooler_dense = nn.Linear(config.hidden_size, config.hidden_size)
     self.pooler_af = nn.Tanh()
 
+    # Recompute BertLayer activations in the backward pass instead of storing them.
+    self.gradient_checkpointing = False
+
     self.init_weights()
 
+  def gradient_checkpointing_enable(self):
+    self.gradient_checkpointing = True
+
+  def gradient_checkpointing_disable(self):
+    self.gradient_checkpointing = False
+
   def embed(self, input_ids):
     input_shape = input_ids.size()
     seq_length = input_shape[1]
@@ -221,7 +231,10 @@ class BertModel(BertPreTrainedModel):
     # Pass the hidden states through the encoder layers.
     for i, layer_module in enumerate(self.bert_layers):
       # Feed the encoding from the last bert_layer to the next.
-      hidden_states = layer_module(hidden_states, extended_attention_mask)
+      if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+        hidden_states = checkpoint(layer_module, hidden_states, extended_attention_mask, use_reentrant=False)
+      else:
+        hidden_states = layer_module(hidden_states, extended_attention_mask)
 
     return hidden_states
 
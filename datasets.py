@@ -11,7 +11,7 @@ examples are preprocessed.
 import csv
 
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 from tokenizer import BertTokenizer
 
 
@@ -24,27 +24,92 @@ def preprocess_string(s):
                     .split())
 
 
+def use_pinned_memory(device):
+    '''Whether to pin loader memory and copy batches with non_blocking=True.
+
+    Both only pay off on CUDA, where copies from pinned memory overlap with queued
+    kernels. On MPS a non_blocking copy is not guaranteed to have finished before the
+    host reuses the batch, and on CPU there is nothing to overlap, so both stay off.
+    '''
+    return device.type == 'cuda'
+
+
+def pad_token_ids(token_ids_list, pad_token_id):
+    '''Pads a batch of pre-tokenized sentences to the length of the longest one.'''
+    max_len = max(len(ids) for ids in token_ids_list)
+    token_ids = torch.full((len(token_ids_list), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(token_ids_list), max_len), dtype=torch.long)
+    for i, ids in enumerate(token_ids_list):
+        token_ids[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[i, :len(ids)] = 1
+    return token_ids, attention_mask
+
+
+class BucketBatchSampler(Sampler):
+    '''Yields batches of indices whose sentences have similar token lengths.
+
+    Indices are shuffled and split into buckets of bucket_size * batch_size examples.
+    Each bucket is sorted by length and cut into batches, and the batch order is then
+    shuffled, so batches stay random while padding inside a batch is kept small.
+
+    For distributed training, every process builds the same batch order from
+    seed + epoch (see set_epoch) and keeps every num_replicas-th batch starting at
+    rank, so that all processes run the same number of steps.
+    '''
+    def __init__(self, lengths, batch_size, bucket_size=50, num_replicas=1, rank=0, seed=0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        num_buckets, remainder = divmod(len(self.lengths), self.batch_size * self.bucket_size)
+        num_batches = num_buckets * self.bucket_size + -(-remainder // self.batch_size)
+        return num_batches // self.num_replicas
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.lengths), generator=generator).tolist()
+        bucket_len = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), bucket_len):
+            bucket = sorted(indices[start:start + bucket_len], key=lambda i: self.lengths[i])
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        order = torch.randperm(len(batches), generator=generator).tolist()
+        for i in order[self.rank::self.num_replicas][:len(self)]:
+            yield batches[i]
+
+
+# The datasets tokenize every sentence once at construction time, so collate_fn
+# only has to pad the cached token ids instead of re-tokenizing on every epoch.
 class SentenceClassificationDataset(Dataset):
     def __init__(self, dataset, args):
         self.dataset = dataset
         self.p = args
         self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.token_ids = self.tokenizer([x[0] for x in dataset], truncation=True)['input_ids']
+        self.lengths = [len(ids) for ids in self.token_ids]
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, idx):
-        return self.dataset[idx]
+        return self.dataset[idx], self.token_ids[idx]
 
     def pad_data(self, data):
 
-        sents = [x[0] for x in data]
-        labels = [x[1] for x in data]
-        sent_ids = [x[2] for x in data]
+        sents = [x[0] for x, _ in data]
+        labels = [x[1] for x, _ in data]
+        sent_ids = [x[2] for x, _ in data]
 
-        encoding = self.tokenizer(sents, return_tensors='pt', padding=True, truncation=True)
-        token_ids = torch.LongTensor(encoding['input_ids'])
-        attention_mask = torch.LongTensor(encoding['attention_mask'])
+        token_ids, attention_mask = pad_token_ids([ids for _, ids in data], self.tokenizer.pad_token_id)
         labels = torch.LongTensor(labels)
 
         return token_ids, attention_mask, labels, sents, sent_ids
@@ -69,20 +134,19 @@ class SentenceClassificationTestDataset(Dataset):
         self.dataset = dataset
         self.p = args
         self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.token_ids = self.tokenizer([x[0] for x in dataset], truncation=True)['input_ids']
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, idx):
-        return self.dataset[idx]
+        return self.dataset[idx], self.token_ids[idx]
 
     def pad_data(self, data):
-        sents = [x[0] for x in data]
-        sent_ids = [x[1] for x in data]
+        sents = [x[0] for x, _ in data]
+        sent_ids = [x[1] for x, _ in data]
 
-        encoding = self.tokenizer(sents, return_tensors='pt', padding=True, truncation=True)
-        token_ids = torch.LongTensor(encoding['input_ids'])
-        attention_mask = torch.LongTensor(encoding['attention_mask'])
+        token_ids, attention_mask = pad_token_ids([ids for _, ids in data], self.tokenizer.pad_token_id)
 
         return token_ids, attention_mask, sents, sent_ids
 
@@ -105,29 +169,24 @@ class SentencePairDataset(Dataset):
         self.p = args
         self.isRegression = isRegression 
         self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.token_ids_1 = self.tokenizer([x[0] for x in dataset], truncation=True)['input_ids']
+        self.token_ids_2 = self.tokenizer([x[1] for x in dataset], truncation=True)['input_ids']
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, idx):
-        return self.dataset[idx]
+        return self.dataset[idx], self.token_ids_1[idx], self.token_ids_2[idx]
 
     def pad_data(self, data):
-        sent1 = [x[0] for x in data]
-        sent2 = [x[1] for x in data]
-        labels = [x[2] for x in data]
-        sent_ids = [x[3] for x in data]
-
-        encoding1 = self.tokenizer(sent1, return_tensors='pt', padding=True, truncation=True)
-        encoding2 = self.tokenizer(sent2, return_tensors='pt', padding=True, truncation=True)
+        labels = [x[2] for x, _, _ in data]
+        sent_ids = [x[3] for x, _, _ in data]
 
-        token_ids = torch.LongTensor(encoding1['input_ids'])
-        attention_mask = torch.LongTensor(encoding1['attention_mask'])
-        token_type_ids = torch.LongTensor(encoding1['token_type_ids'])
+        token_ids, attention_mask = pad_token_ids([ids for _, ids, _ in data], self.tokenizer.pad_token_id)
+        token_type_ids = torch.zeros_like(token_ids)
 
-        token_ids2 = torch.LongTensor(encoding2['input_ids'])
-        attention_mask2 = torch.LongTensor(encoding2['attention_mask'])
-        token_type_ids2 = torch.LongTensor(encoding2['token_type_ids'])
+        token_ids2, attention_mask2 = pad_token_ids([ids for _, _, ids in data], self.tokenizer.pad_token_id)
+        token_type_ids2 = torch.zeros_like(token_ids2)
         if self.isRegression:
             labels = torch.DoubleTensor(labels)
         else:
@@ -162,28 +221,23 @@ class SentencePairTestDataset(Dataset):
         self.dataset = dataset
         self.p = args
         self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.token_ids_1 = self.tokenizer([x[0] for x in dataset], truncation=True)['input_ids']
+        self.token_ids_2 = self.tokenizer([x[1] for x in dataset], truncation=True)['input_ids']
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, idx):
-        return self.dataset[idx]
+        return self.dataset[idx], self.token_ids_1[idx], self.token_ids_2[idx]
 
     def pad_data(self, data):
-        sent1 = [x[0] for x in data]
-        sent2 = [x[1] for x in data]
-        sent_ids = [x[2] for x in data]
-
-        encoding1 = self.tokenizer(sent1, return_tensors='pt', padding=True, truncation=True)
-        encoding2 = self.tokenizer(sent2, return_tensors='pt', padding=True, truncation=True)
+        sent_ids = [x[2] for x, _, _ in data]
 
-        token_ids = torch.LongTensor(encoding1['input_ids'])
-        attention_mask = torch.LongTensor(encoding1['attention_mask'])
-        token_type_ids = torch.LongTensor(encoding1['token_type_ids'])
+        token_ids, attention_mask = pad_token_ids([ids for _, ids, _ in data], self.tokenizer.pad_token_id)
+        token_type_ids = torch.zeros_like(token_ids)
 
-        token_ids2 = torch.LongTensor(encoding2['input_ids'])
-        attention_mask2 = torch.LongTensor(encoding2['attention_mask'])
-        token_type_ids2 = torch.LongTensor(encoding2['token_type_ids'])
+        token_ids2, attention_mask2 = pad_token_ids([ids for _, _, ids in data], self.tokenizer.pad_token_id)
+        token_type_ids2 = torch.zeros_like(token_ids2)
 
 
         return (token_ids, token_type_ids, attention_mask,
@@ -12,6 +12,8 @@ from sklearn.metrics import f1_score, accuracy_score
 from tqdm import tqdm
 import numpy as np
 
+from datasets import use_pinned_memory
+
 
 TQDM_DISABLE = False
 
@@ -19,31 +21,34 @@ TQDM_DISABLE = False
 # Evaluate multitask model on SST only.
 def model_eval_sst(dataloader, model, device):
     model.eval()  # Switch to eval model, will turn off randomness like dropout.
-    y_true = []
-    y_pred = []
-    sents = []
-    sent_ids = []
-    for step, batch in enumerate(tqdm(dataloader, desc=f'eval', disable=TQDM_DISABLE)):
-        b_ids, b_mask, b_labels, b_sents, b_sent_ids = batch['token_ids'],batch['attention_mask'],  \
-                                                        batch['labels'], batch['sents'], batch['sent_ids']
+    non_blocking = use_pinned_memory(device)
+
+    with torch.inference_mode():
+        y_true = []
+        y_pred = []
+        sents = []
+        sent_ids = []
+        for step, batch in enumerate(tqdm(dataloader, desc=f'eval', disable=TQDM_DISABLE)):
+            b_ids, b_mask, b_labels, b_sents, b_sent_ids = batch['token_ids'],batch['attention_mask'],  \
+                                                            batch['labels'], batch['sents'], batch['sent_ids']
 
-        b_ids = b_ids.to(device)
-        b_mask = b_mask.to(device)
+            b_ids = b_ids.to(device, non_blocking=non_blocking)
+            b_mask = b_mask.to(device, non_blocking=non_blocking)
 
-        logits = model.predict_sentiment(b_ids, b_mask)
-        logits = logits.detach().cpu().numpy()
-        preds = np.argmax(logits, axis=1).flatten()
+            logits = model.predict_sentiment(b_ids, b_mask)
+            logits = logits.detach().cpu().numpy()
+            preds = np.argmax(logits, axis=1).flatten()
 
-        b_labels = b_labels.flatten()
-        y_true.extend(b_labels)
-        y_pred.extend(preds)
-        sents.extend(b_sents)
-        sent_ids.extend(b_sent_ids)
+            b_labels = b_labels.flatten()
+            y_true.extend(b_labels)
+            y_pred.extend(preds)
+            sents.extend(b_sents)
+            sent_ids.extend(b_sent_ids)
 
-    f1 = f1_score(y_true, y_pred, average='macro')
-    acc = accuracy_score(y_true, y_pred)
+        f1 = f1_score(y_true, y_pred, average='macro')
+        acc = accuracy_score(y_true, y_pred)
 
-    return acc, f1, y_pred, y_true, sents, sent_ids
+        return acc, f1, y_pred, y_true, sents, sent_ids
 
 
 # Evaluate multitask model on dev sets.
@@ -52,8 +57,9 @@ def model_eval_multitask(sentiment_dataloader,
                          sts_dataloader,
                          model, device):
     model.eval()  # Switch to eval model, will turn off randomness like dropout.
+    non_blocking = use_pinned_memory(device)
 
-    with torch.no_grad():
+    with torch.inference_mode():
         # Evaluate sentiment classification.
         sst_y_true = []
         sst_y_pred = []
@@ -61,8 +67,8 @@ def model_eval_multitask(sentiment_dataloader,
         for step, batch in enumerate(tqdm(sentiment_dataloader, desc=f'eval', disable=TQDM_DISABLE)):
             b_ids, b_mask, b_labels, b_sent_ids = batch['token_ids'], batch['attention_mask'], batch['labels'], batch['sent_ids']
 
-            b_ids = b_ids.to(device)
-            b_mask = b_mask.to(device)
+            b_ids = b_ids.to(device, non_blocking=non_blocking)
+            b_mask = b_mask.to(device, non_blocking=non_blocking)
 
             logits = model.predict_sentiment(b_ids, b_mask)
             y_hat = logits.argmax(dim=-1).flatten().cpu().numpy()
@@ -85,10 +91,10 @@ def model_eval_multitask(sentiment_dataloader,
                           batch['token_ids_2'], batch['attention_mask_2'],
                           batch['labels'], batch['sent_ids'])
 
-            b_ids1 = b_ids1.to(device)
-            b_mask1 = b_mask1.to(device)
-            b_ids2 = b_ids2.to(device)
-            b_mask2 = b_mask2.to(device)
+            b_ids1 = b_ids1.to(device, non_blocking=non_blocking)
+            b_mask1 = b_mask1.to(device, non_blocking=non_blocking)
+            b_ids2 = b_ids2.to(device, non_blocking=non_blocking)
+            b_mask2 = b_mask2.to(device, non_blocking=non_blocking)
 
             logits = model.predict_paraphrase(b_ids1, b_mask1, b_ids2, b_mask2)
             y_hat = logits.sigmoid().round().flatten().cpu().numpy()
@@ -111,10 +117,10 @@ def model_eval_multitask(sentiment_dataloader,
                           batch['token_ids_2'], batch['attention_mask_2'],
                           batch['labels'], batch['sent_ids'])
 
-            b_ids1 = b_ids1.to(device)
-            b_mask1 = b_mask1.to(device)
-            b_ids2 = b_ids2.to(device)
-            b_mask2 = b_mask2.to(device)
+            b_ids1 = b_ids1.to(device, non_blocking=non_blocking)
+            b_mask1 = b_mask1.to(device, non_blocking=non_blocking)
+            b_ids2 = b_ids2.to(device, non_blocking=non_blocking)
+            b_mask2 = b_mask2.to(device, non_blocking=non_blocking)
 
             logits = model.predict_similarity(b_ids1, b_mask1, b_ids2, b_mask2)
             y_hat = logits.flatten().cpu().numpy()
@@ -141,16 +147,17 @@ def model_eval_test_multitask(sentiment_dataloader,
                          sts_dataloader,
                          model, device):
     model.eval()  # Switch to eval model, will turn off randomness like dropout.
+    non_blocking = use_pinned_memory(device)
 
-    with torch.no_grad():
+    with torch.inference_mode():
         # Evaluate sentiment classification.
         sst_y_pred = []
         sst_sent_ids = []
         for step, batch in enumerate(tqdm(sentiment_dataloader, desc=f'eval', disable=TQDM_DISABLE)):
             b_ids, b_mask, b_sent_ids = batch['token_ids'], batch['attention_mask'],  batch['sent_ids']
 
-            b_ids = b_ids.to(device)
-            b_mask = b_mask.to(device)
+            b_ids = b_ids.to(device, non_blocking=non_blocking)
+            b_mask = b_mask.to(device, non_blocking=non_blocking)
 
             logits = model.predict_sentiment(b_ids, b_mask)
             y_hat = logits.argmax(dim=-1).flatten().cpu().numpy()
@@ -168,10 +175,10 @@ def model_eval_test_multitask(sentiment_dataloader,
                           batch['token_ids_2'], batch['attention_mask_2'],
                           batch['sent_ids'])
 
-            b_ids1 = b_ids1.to(device)
-            b_mask1 = b_mask1.to(device)
-            b_ids2 = b_ids2.to(device)
-            b_mask2 = b_mask2.to(device)
+            b_ids1 = b_ids1.to(device, non_blocking=non_blocking)
+            b_mask1 = b_mask1.to(device, non_blocking=non_blocking)
+            b_ids2 = b_ids2.to(device, non_blocking=non_blocking)
+            b_mask2 = b_mask2.to(device, non_blocking=non_blocking)
 
             logits = model.predict_paraphrase(b_ids1, b_mask1, b_ids2, b_mask2)
             y_hat = logits.sigmoid().round().flatten().cpu().numpy()
@@ -189,10 +196,10 @@ def model_eval_test_multitask(sentiment_dataloader,
                           batch['token_ids_2'], batch['attention_mask_2'],
                           batch['sent_ids'])
 
-            b_ids1 = b_ids1.to(device)
-            b_mask1 = b_mask1.to(device)
-            b_ids2 = b_ids2.to(device)
-            b_mask2 = b_mask2.to(device)
+            b_ids1 = b_ids1.to(device, non_blocking=non_blocking)
+            b_mask1 = b_mask1.to(device, non_blocking=non_blocking)
+            b_ids2 = b_ids2.to(device, non_blocking=non_blocking)
+            b_mask2 = b_mask2.to(device, non_blocking=non_blocking)
 
             logits = model.predict_similarity(b_ids1, b_mask1, b_ids2, b_mask2)
             y_hat = logits.flatten().cpu().numpy()
@@ -12,10 +12,13 @@ Running `python multitask_classifier.py` trains and tests your MultitaskBERT and
 writes all required submission files.
 '''
 
-import random, numpy as np, argparse
+import os, random, numpy as np, argparse
+from contextlib import nullcontext
 from types import SimpleNamespace
 
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch import nn
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
@@ -29,7 +32,9 @@ from datasets import (
     SentenceClassificationTestDataset,
     SentencePairDataset,
     SentencePairTestDataset,
-    load_multitask_data
+    BucketBatchSampler,
+    load_multitask_data,
+    use_pinned_memory
 )
 
 from evaluation import model_eval_sst, model_eval_multitask, model_eval_test_multitask
@@ -45,8 +50,15 @@ def seed_everything(seed=11711):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
-    torch.backends.cudnn.benchmark = False
-    torch.backends.cudnn.deterministic = True
+
+
+# Bit-exact reproducibility costs throughput, so it is opt-in.
+def configure_backends(deterministic=False):
+    torch.backends.cudnn.benchmark = not deterministic
+    torch.backends.cudnn.deterministic = deterministic
+    if not deterministic:
+        # Allow TF32 tensor cores for fp32 matmuls on Ampere and newer GPUs.
+        torch.set_float32_matmul_precision('high')
 
 
 BERT_HIDDEN_SIZE = 768
@@ -64,30 +76,58 @@ class MultitaskBERT(nn.Module):
     def __init__(self, config):
         super(MultitaskBERT, self).__init__()
         self.bert = BertModel.from_pretrained('bert-base-uncased')
+        self._bert_frozen = config.option == 'pretrain'
         # Pretrain mode does not require updating BERT paramters.
         for param in self.bert.parameters():
             if config.option == 'pretrain':
                 param.requires_grad = False
             elif config.option == 'finetune':
                 param.requires_grad = True
+        # Trade extra compute for activation memory, allowing larger batches.
+        if getattr(config, 'grad_ckpt', False):
+            self.bert.gradient_checkpointing_enable()
         # You will want to add layers here to perform the downstream tasks.
         ### TODO
         self.dropout = torch.nn.Dropout(config.hidden_dropout_prob)
         self.fc = torch.nn.Linear(config.hidden_size, N_SENTIMENT_CLASSES)
         self.fc2 = torch.nn.Linear(config.hidden_size, 2)
 
-    def forward(self, input_ids, attention_mask):
-        'Takes a batch of sentences and produces embeddings for them.'
+    def forward(self, input_ids, attention_mask, task=None):
+        '''Takes a batch of sentences and produces embeddings for them.
+        With task='sentiment' it returns the sentiment logits instead, so that a whole
+        training step goes through forward() (DistributedDataParallel only hooks forward()).
+        '''
+        if task == 'sentiment':
+            return self.predict_sentiment(input_ids, attention_mask)
         # The final BERT embedding is the hidden state of [CLS] token (the first token)
         # Here, you can start by just returning the embeddings straight from BERT.
         # When thinking of improvements, you can later try modifying this
         # (e.g., by adding other layers).
         ### TODO
-        outputs = self.bert(input_ids, attention_mask)
+        if self._bert_frozen:
+            # No autograd graph is needed through a frozen BERT.
+            with torch.no_grad():
+                outputs = self.bert(input_ids, attention_mask)
+        else:
+            outputs = self.bert(input_ids, attention_mask)
         pooler_output = outputs['pooler_output']
         return pooler_output
 
 
+    def forward_multi(self, input_ids_list, attention_mask_list):
+        '''Embeds several batches of sentences with a single BERT call.
+        The batches are padded to a common length and stacked along the batch
+        dimension; the pooled output is split back into one tensor per input batch.
+        '''
+        seq_len = max(input_ids.size(1) for input_ids in input_ids_list)
+        pad_token_id = self.bert.config.pad_token_id
+        input_ids = torch.cat([F.pad(ids, (0, seq_len - ids.size(1)), value=pad_token_id)
+                               for ids in input_ids_list], dim=0)
+        attention_mask = torch.cat([F.pad(mask, (0, seq_len - mask.size(1))) for mask in attention_mask_list], dim=0)
+        output = self.forward(input_ids, attention_mask)
+        return output.split([ids.size(0) for ids in input_ids_list], dim=0)
+
+
     def predict_sentiment(self, input_ids, attention_mask):
         '''Given a batch of sentences, outputs logits for classifying sentiment.
         There are 5 sentiment classes:
@@ -108,8 +148,8 @@ class MultitaskBERT(nn.Module):
         during evaluation.
         '''
         ### TODO
-        output_1 = self.forward(input_ids_1, attention_mask_1)
-        output_2 = self.forward(input_ids_2, attention_mask_2)
+        output_1, output_2 = self.forward_multi([input_ids_1, input_ids_2],
+                                                [attention_mask_1, attention_mask_2])
         logits = torch.sum(output_1 * output_2, dim=1)
         return logits
     
@@ -126,14 +166,23 @@ class MultitaskBERT(nn.Module):
         Note that your output should be unnormalized (a logit).
         '''
         ### TODO
-        output_1 = self.forward(input_ids_1, attention_mask_1)
-        output_2 = self.forward(input_ids_2, attention_mask_2)
+        output_1, output_2 = self.forward_multi([input_ids_1, input_ids_2],
+                                                [attention_mask_1, attention_mask_2])
         logits = torch.sum(output_1 * output_2, dim=1)
         return logits
 
 
 
 
+def get_device(args):
+    '''Returns this process's GPU when running distributed, else the single-process device.'''
+    if args.local_rank != -1:
+        return torch.device('cuda', args.local_rank)
+    if args.use_gpu:
+        return torch.device('cuda') if torch.cuda.is_available() else torch.device('mps')
+    return torch.device('cpu')
+
+
 def save_model(model, optimizer, args, config, filepath):
     save_info = {
         'model': model.state_dict(),
@@ -149,6 +198,12 @@ def save_model(model, optimizer, args, config, filepath):
     print(f"save the model to {filepath}")
 
 
+def write_predictions(filepath, header, sent_ids, preds):
+    '''Writes a prediction file in the submission format with a single write call.'''
+    with open(filepath, "w+") as f:
+        f.write(f"id \t {header} \n" + "".join(f"{p} , {s} \n" for p, s in zip(sent_ids, preds)))
+
+
 def train_multitask(args):
     '''Train MultitaskBERT.
 
@@ -157,7 +212,14 @@ def train_multitask(args):
     look at test_multitask below to see how you can use the custom torch `Dataset`s
     in datasets.py to load in examples from the Quora and SemEval datasets.
     '''
-    device = torch.device('mps') if args.use_gpu else torch.device('cpu')
+    device = get_device(args)
+    # Autocast supports bf16 on CUDA and CPU; fp16 loss scaling needs CUDA.
+    if (args.precision == 'bf16' and device.type not in ('cuda', 'cpu')) or \
+            (args.precision == 'fp16' and device.type != 'cuda'):
+        raise ValueError(f"--precision {args.precision} is not supported on device '{device.type}'")
+    distributed = args.local_rank != -1
+    is_main_process = not distributed or dist.get_rank() == 0
+    pin_memory = use_pinned_memory(device)
     # Create the data and its corresponding datasets and dataloader.
     sst_train_data, num_labels,para_train_data, sts_train_data = load_multitask_data(args.sst_train,args.para_train,args.sts_train, split ='train')
     sst_dev_data, num_labels,para_dev_data, sts_dev_data = load_multitask_data(args.sst_dev,args.para_dev,args.sts_dev, split ='train')
@@ -165,53 +227,93 @@ def train_multitask(args):
     sst_train_data = SentenceClassificationDataset(sst_train_data, args)
     sst_dev_data = SentenceClassificationDataset(sst_dev_data, args)
 
-    sst_train_dataloader = DataLoader(sst_train_data, shuffle=True, batch_size=args.batch_size,
-                                      collate_fn=sst_train_data.collate_fn)
+    # Group training sentences of similar length to cut down on padding, and give
+    # each distributed process its own share of the batches.
+    sst_train_sampler = BucketBatchSampler(sst_train_data.lengths, args.batch_size,
+                                           num_replicas=dist.get_world_size() if distributed else 1,
+                                           rank=dist.get_rank() if distributed else 0,
+                                           seed=args.seed)
+    sst_train_dataloader = DataLoader(sst_train_data, batch_sampler=sst_train_sampler,
+                                      collate_fn=sst_train_data.collate_fn, pin_memory=pin_memory)
     sst_dev_dataloader = DataLoader(sst_dev_data, shuffle=False, batch_size=args.batch_size,
-                                    collate_fn=sst_dev_data.collate_fn)
+                                    collate_fn=sst_dev_data.collate_fn, pin_memory=pin_memory)
 
     # Init model.
     config = {'hidden_dropout_prob': args.hidden_dropout_prob,
               'num_labels': num_labels,
               'hidden_size': 768,
               'data_dir': '.',
-              'option': args.option}
+              'option': args.option,
+              'grad_ckpt': args.grad_ckpt}
 
     config = SimpleNamespace(**config)
 
     model = MultitaskBERT(config)
     model = model.to(device)
+    if args.compile:
+        # Compile the BERT backbone in place, so that the predict_* heads also go
+        # through the compiled graph and state_dict keys keep their usual names.
+        model.bert.compile()
+    # Training steps go through train_model; evaluation and checkpoints use the bare model.
+    train_model = model
+    if distributed:
+        # DDP broadcasts rank 0's weights and all-reduces gradients in buckets during
+        # backward. fc2 never receives a gradient, hence find_unused_parameters.
+        train_model = DistributedDataParallel(model, device_ids=[args.local_rank],
+                                              find_unused_parameters=True)
+        # Give each process its own dropout stream.
+        seed_everything(args.seed + dist.get_rank())
 
     lr = args.lr
     optimizer = AdamW(model.parameters(), lr=lr)
     best_dev_acc = 0
 
+    # Mixed precision: fp16 needs loss scaling to avoid gradient underflow, bf16 does not.
+    amp_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}.get(args.precision)
+    scaler = torch.cuda.amp.GradScaler() if args.precision == 'fp16' else None
+
     # Run for the specified number of epochs.
     for epoch in range(args.epochs):
-        model.train()
+        sst_train_sampler.set_epoch(epoch)
+        train_model.train()
         train_loss = 0
         num_batches = 0
         for batch in tqdm(sst_train_dataloader, desc=f'train-{epoch}', disable=TQDM_DISABLE):
             b_ids, b_mask, b_labels = (batch['token_ids'],
                                        batch['attention_mask'], batch['labels'])
 
-            b_ids = b_ids.to(device)
-            b_mask = b_mask.to(device)
-            b_labels = b_labels.to(device)
+            b_ids = b_ids.to(device, non_blocking=pin_memory)
+            b_mask = b_mask.to(device, non_blocking=pin_memory)
+            b_labels = b_labels.to(device, non_blocking=pin_memory)
 
-            optimizer.zero_grad()
-            logits = model.predict_sentiment(b_ids, b_mask)
-            loss = F.cross_entropy(logits, b_labels.view(-1), reduction='sum') / args.batch_size
+            optimizer.zero_grad(set_to_none=True)
+            with torch.autocast(device.type, dtype=amp_dtype) if amp_dtype is not None else nullcontext():
+                logits = train_model(b_ids, b_mask, task='sentiment')
+                loss = F.cross_entropy(logits, b_labels.view(-1), reduction='sum') / args.batch_size
 
-            loss.backward()
-            optimizer.step()
+            if scaler is not None:
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                loss.backward()
+                optimizer.step()
 
             train_loss += loss.item()
             num_batches += 1
 
         train_loss = train_loss / (num_batches)
 
-        train_acc, train_f1, *_ = model_eval_sst(sst_train_dataloader, model, device)
+        # Every process holds the same weights, so only the main one evaluates and saves.
+        if not is_main_process:
+            continue
+
+        # Evaluating on the training set re-runs BERT over every training example,
+        # so it is opt-in; the reported train acc is nan when it is skipped.
+        if args.train_eval:
+            train_acc, train_f1, *_ = model_eval_sst(sst_train_dataloader, model, device)
+        else:
+            train_acc = float('nan')
         dev_acc, dev_f1, *_ = model_eval_sst(sst_dev_dataloader, model, device)
 
         if dev_acc > best_dev_acc:
@@ -223,16 +325,20 @@ def train_multitask(args):
 
 def test_multitask(args):
     '''Test and save predictions on the dev and test sets of all three tasks.'''
-    with torch.no_grad():
-        device = torch.device('mps') if args.use_gpu else torch.device('cpu')
-        saved = torch.load(args.filepath)
-        config = saved['model_config']
+    device = get_device(args)
+    pin_memory = use_pinned_memory(device)
+    saved = torch.load(args.filepath)
+    config = saved['model_config']
 
-        model = MultitaskBERT(config)
-        model.load_state_dict(saved['model'])
-        model = model.to(device)
-        print(f"Loaded model to test from {args.filepath}")
+    model = MultitaskBERT(config)
+    model.load_state_dict(saved['model'])
+    model = model.to(device)
+    if args.compile:
+        model.bert.compile()
+    print(f"Loaded model to test from {args.filepath}")
 
+    # The model is built outside inference mode so that its parameters stay normal tensors.
+    with torch.inference_mode():
         sst_test_data, num_labels,para_test_data, sts_test_data = \
             load_multitask_data(args.sst_test,args.para_test, args.sts_test, split='test')
 
@@ -243,25 +349,25 @@ def test_multitask(args):
         sst_dev_data = SentenceClassificationDataset(sst_dev_data, args)
 
         sst_test_dataloader = DataLoader(sst_test_data, shuffle=True, batch_size=args.batch_size,
-                                         collate_fn=sst_test_data.collate_fn)
+                                         collate_fn=sst_test_data.collate_fn, pin_memory=pin_memory)
         sst_dev_dataloader = DataLoader(sst_dev_data, shuffle=False, batch_size=args.batch_size,
-                                        collate_fn=sst_dev_data.collate_fn)
+                                        collate_fn=sst_dev_data.collate_fn, pin_memory=pin_memory)
 
         para_test_data = SentencePairTestDataset(para_test_data, args)
         para_dev_data = SentencePairDataset(para_dev_data, args)
 
         para_test_dataloader = DataLoader(para_test_data, shuffle=True, batch_size=args.batch_size,
-                                          collate_fn=para_test_data.collate_fn)
+                                          collate_fn=para_test_data.collate_fn, pin_memory=pin_memory)
         para_dev_dataloader = DataLoader(para_dev_data, shuffle=False, batch_size=args.batch_size,
-                                         collate_fn=para_dev_data.collate_fn)
+                                         collate_fn=para_dev_data.collate_fn, pin_memory=pin_memory)
 
         sts_test_data = SentencePairTestDataset(sts_test_data, args)
         sts_dev_data = SentencePairDataset(sts_dev_data, args, isRegression=True)
 
         sts_test_dataloader = DataLoader(sts_test_data, shuffle=True, batch_size=args.batch_size,
-                                         collate_fn=sts_test_data.collate_fn)
+                                         collate_fn=sts_test_data.collate_fn, pin_memory=pin_memory)
         sts_dev_dataloader = DataLoader(sts_dev_data, shuffle=False, batch_size=args.batch_size,
-                                        collate_fn=sts_dev_data.collate_fn)
+                                        collate_fn=sts_dev_data.collate_fn, pin_memory=pin_memory)
 
         dev_sentiment_accuracy,dev_sst_y_pred, dev_sst_sent_ids, \
             dev_paraphrase_accuracy, dev_para_y_pred, dev_para_sent_ids, \
@@ -275,38 +381,17 @@ def test_multitask(args):
                                           para_test_dataloader,
                                           sts_test_dataloader, model, device)
 
-        with open(args.sst_dev_out, "w+") as f:
-            print(f"dev sentiment acc :: {dev_sentiment_accuracy :.3f}")
-            f.write(f"id \t Predicted_Sentiment \n")
-            for p, s in zip(dev_sst_sent_ids, dev_sst_y_pred):
-                f.write(f"{p} , {s} \n")
-
-        with open(args.sst_test_out, "w+") as f:
-            f.write(f"id \t Predicted_Sentiment \n")
-            for p, s in zip(test_sst_sent_ids, test_sst_y_pred):
-                f.write(f"{p} , {s} \n")
-
-        with open(args.para_dev_out, "w+") as f:
-            print(f"dev paraphrase acc :: {dev_paraphrase_accuracy :.3f}")
-            f.write(f"id \t Predicted_Is_Paraphrase \n")
-            for p, s in zip(dev_para_sent_ids, dev_para_y_pred):
-                f.write(f"{p} , {s} \n")
-
-        with open(args.para_test_out, "w+") as f:
-            f.write(f"id \t Predicted_Is_Paraphrase \n")
-            for p, s in zip(test_para_sent_ids, test_para_y_pred):
-                f.write(f"{p} , {s} \n")
+        print(f"dev sentiment acc :: {dev_sentiment_accuracy :.3f}")
+        write_predictions(args.sst_dev_out, "Predicted_Sentiment", dev_sst_sent_ids, dev_sst_y_pred)
+        write_predictions(args.sst_test_out, "Predicted_Sentiment", test_sst_sent_ids, test_sst_y_pred)
 
-        with open(args.sts_dev_out, "w+") as f:
-            print(f"dev sts corr :: {dev_sts_corr :.3f}")
-            f.write(f"id \t Predicted_Similiary \n")
-            for p, s in zip(dev_sts_sent_ids, dev_sts_y_pred):
-                f.write(f"{p} , {s} \n")
+        print(f"dev paraphrase acc :: {dev_paraphrase_accuracy :.3f}")
+        write_predictions(args.para_dev_out, "Predicted_Is_Paraphrase", dev_para_sent_ids, dev_para_y_pred)
+        write_predictions(args.para_test_out, "Predicted_Is_Paraphrase", test_para_sent_ids, test_para_y_pred)
 
-        with open(args.sts_test_out, "w+") as f:
-            f.write(f"id \t Predicted_Similiary \n")
-            for p, s in zip(test_sts_sent_ids, test_sts_y_pred):
-                f.write(f"{p} , {s} \n")
+        print(f"dev sts corr :: {dev_sts_corr :.3f}")
+        write_predictions(args.sts_dev_out, "Predicted_Similiary", dev_sts_sent_ids, dev_sts_y_pred)
+        write_predictions(args.sts_test_out, "Predicted_Similiary", test_sts_sent_ids, test_sts_y_pred)
 
 
 def get_args():
@@ -324,11 +409,16 @@ def get_args():
     parser.add_argument("--sts_test", type=str, default="data/sts-test-student.csv")
 
     parser.add_argument("--seed", type=int, default=11711)
+    parser.add_argument("--deterministic", action='store_true',
+                        help='use deterministic cuDNN kernels and full fp32 matmuls for reproducible runs')
     parser.add_argument("--epochs", type=int, default=10)
     parser.add_argument("--option", type=str,
                         help='pretrain: the BERT parameters are frozen; finetune: BERT parameters are updated',
                         choices=('pretrain', 'finetune'), default="pretrain")
     parser.add_argument("--use_gpu", action='store_true')
+    parser.add_argument("--compile", action='store_true', help='compile the BERT backbone with torch.compile')
+    parser.add_argument("--train_eval", action='store_true', help='also report accuracy on the training set every epoch')
+    parser.add_argument("--grad_ckpt", action='store_true', help='use gradient checkpointing on the BERT layers')
 
     parser.add_argument("--sst_dev_out", type=str, default="predictions/sst-dev-output.csv")
     parser.add_argument("--sst_test_out", type=str, default="predictions/sst-test-output.csv")
@@ -342,8 +432,13 @@ def get_args():
     parser.add_argument("--batch_size", help='sst: 64, cfimdb: 8 can fit a 12GB GPU', type=int, default=8)
     parser.add_argument("--hidden_dropout_prob", type=float, default=0.3)
     parser.add_argument("--lr", type=float, help="learning rate", default=1e-5)
+    parser.add_argument("--precision", type=str, help='training precision; bf16/fp16 use autocast',
+                        choices=('fp32', 'bf16', 'fp16'), default="fp32")
 
     args = parser.parse_args()
+    # Multi-GPU training must be launched with torchrun, which sets LOCAL_RANK together with
+    # the rendezvous environment (MASTER_ADDR, WORLD_SIZE, ...) that init_process_group needs.
+    args.local_rank = int(os.environ.get('LOCAL_RANK', -1))
     return args
 
 
@@ -351,5 +446,15 @@ if __name__ == "__main__":
     args = get_args()
     args.filepath = f'{args.option}-{args.epochs}-{args.lr}-multitask.pt' # Save path.
     seed_everything(args.seed)  # Fix the seed for reproducibility.
+    configure_backends(args.deterministic)
+    if args.local_rank != -1:
+        # Launched with torchrun: one process per GPU.
+        dist.init_process_group('nccl')
+        torch.cuda.set_device(args.local_rank)
+    is_main_process = args.local_rank == -1 or dist.get_rank() == 0
     train_multitask(args)
-    test_multitask(args)
+    # Only global rank 0 saves the checkpoint, so only it can test.
+    if is_main_process:
+        test_multitask(args)
+    if args.local_rank != -1:
+        dist.destroy_process_group()
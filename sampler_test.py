@@ -0,0 +1,32 @@
+import torch
+from datasets import BucketBatchSampler
+
+seed = 0
+batch_size = 8
+bucket_size = 5
+
+
+torch.manual_seed(seed)
+# 1003 = 25 full buckets of 40 plus a partial bucket of 3, i.e. 126 batches.
+lengths = torch.randint(1, 64, (1003,)).tolist()
+
+# Single process: every index is yielded exactly once.
+sampler = BucketBatchSampler(lengths, batch_size, bucket_size=bucket_size, seed=seed)
+batches = list(sampler)
+assert len(batches) == len(sampler) == 126
+assert all(len(batch) <= batch_size for batch in batches)
+assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+
+# Distributed: shards are disjoint and equally long (126 batches do not split evenly over 4).
+for num_replicas in (2, 4):
+    shards = [list(BucketBatchSampler(lengths, batch_size, bucket_size=bucket_size,
+                                      num_replicas=num_replicas, rank=rank, seed=seed))
+              for rank in range(num_replicas)]
+    expected_len = len(BucketBatchSampler(lengths, batch_size, bucket_size=bucket_size,
+                                          num_replicas=num_replicas, seed=seed))
+    assert all(len(shard) == expected_len for shard in shards)
+    shard_indices = [[i for batch in shard for i in batch] for shard in shards]
+    all_indices = [i for indices in shard_indices for i in indices]
+    assert len(all_indices) == len(set(all_indices))
+
+print("BucketBatchSampler test passed!")